@@ -1,11 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 import enum
 from lmdbm import Lmdb
 import numpy as np
 import os
+import tempfile
 import tensorflow as tf
 import tensorflow.keras as keras
 import time
 
+from . import dna
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def find_dbs(path):
     """
@@ -15,34 +24,160 @@ def find_dbs(path):
     return sorted(files)
 
 
-def random_subsamples(sample_paths, sequence_length, subsample_size, subsamples_per_sample=1, augment=True, balance=False, rng=None):
+def sample_without_replacement(populations, k, rng):
+    """
+    Draw k unique indices from range(n) for each n in populations using Floyd's algorithm.
+    """
+    if numba is None:
+        return np.array([rng.choice(n, k, replace=False, shuffle=False) for n in populations])
+    out = np.empty((len(populations), k), dtype=np.int64)
+    _floyd_sample_rows(np.asarray(populations), rng.uniform(size=out.shape), out)
+    return out
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _floyd_sample_rows(populations, uniforms, out):
+        k = out.shape[1]
+        for i in numba.prange(out.shape[0]):
+            n = populations[i]
+            selected = set()
+            for j in range(k):
+                t = np.int64(uniforms[i,j] * (n - k + j + 1))
+                if t in selected:
+                    t = n - k + j
+                selected.add(t)
+                out[i,j] = t
+
+
+def sequence_keys(sequence_indices, legacy=False):
+    """
+    Encode sequence indices as database keys (fixed-width 8-byte big-endian integers).
+    """
+    if legacy:
+        return [str(i).encode() for i in sequence_indices]
+    buf = np.asarray(sequence_indices, dtype=">u8").tobytes()
+    return [buf[i:i+8] for i in range(0, len(buf), 8)]
+
+
+def has_legacy_keys(store):
+    """
+    Check if the given database was created with decimal string keys.
+    """
+    return b"0" in store
+
+
+def export_contiguous(store, chunk_size=2**16):
+    """
+    Write the sequences of a database into a single contiguous uint8 file of shape
+    (num_sequences, sequence_length) next to the database. Returns the sequence length.
+    """
+    path = os.path.join(store.env.path(), "data.bin")
+    legacy = has_legacy_keys(store)
+    sequence_length = None
+    # Write to a unique temporary file so that concurrent exports cannot clobber each other
+    fd, tmp_path = tempfile.mkstemp(prefix="data.bin.", suffix=".tmp", dir=store.env.path())
+    try:
+        with os.fdopen(fd, "wb") as f, store.env.begin(buffers=True) as txn:
+            cursor = txn.cursor()
+            for start in range(0, len(store), chunk_size):
+                keys = sequence_keys(range(start, min(start + chunk_size, len(store))), legacy)
+                for _, sequence in cursor.getmulti(keys):
+                    if sequence_length is None:
+                        sequence_length = len(sequence)
+                    elif len(sequence) != sequence_length:
+                        raise ValueError(f"Database contains sequences of varying lengths: {path}")
+                    f.write(sequence)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return sequence_length
+
+
+def contiguous_path(store):
+    """
+    The path to the contiguous sequence file of a database, exporting it first if necessary.
+    """
+    path = os.path.join(store.env.path(), "data.bin")
+    if not os.path.exists(path):
+        export_contiguous(store)
+    return path
+
+
+def read_contiguous(store, mmap=False):
+    """
+    Read the contiguous sequence file of a database as a uint8 array. If mmap is set, the
+    file is memory-mapped read-only so only the pages of the rows touched are read from disk.
+    """
+    path = contiguous_path(store)
+    if mmap:
+        shape = (len(store), os.path.getsize(path) // len(store))
+        return np.memmap(path, dtype=np.uint8, mode="r", shape=shape)
+    return np.fromfile(path, dtype=np.uint8).reshape((len(store), -1))
+
+
+def load_contiguous(store):
+    """
+    Load the contiguous sequence file of a database as a uint8 tensor.
+    """
+    path = contiguous_path(store)
+    sequence_length = os.path.getsize(path) // len(store)
+    sequences = tf.io.decode_raw(tf.io.read_file(path), tf.uint8)
+    return tf.reshape(sequences, (len(store), sequence_length))
+
+
+def batch_to_kmers_tf(batch, kmer):
+    """
+    Encode the last axis of a batch of sequences into k-mers using a 1D convolution.
+    """
+    kernel = tf.constant(5.0**np.arange(kmer - 1, -1, -1), shape=(kmer, 1, 1), dtype=tf.float32)
+    sequences = tf.cast(tf.reshape(batch, (-1, batch.shape[-1], 1)), dtype=tf.float32)
+    encoded = tf.nn.conv1d(sequences, kernel, stride=1, padding="VALID")
+    encoded = tf.cast(encoded, dtype=dna.kmer_dtype(kmer))
+    return tf.reshape(encoded, (*batch.shape[:-1], batch.shape[-1] - kmer + 1))
+
+
+def random_subsamples(samples, sequence_length, subsample_size, subsamples_per_sample=1, augment=True, balance=False, rng=None):
     """
-    Generate random subsamples of the given samples.
+    Generate random subsamples of the given samples, given either as database paths or as
+    already-open stores. Only the stores opened here are closed afterwards.
     """
-    samples = []
-    for sample in sample_paths:
-        store = Lmdb.open(sample)
+    opened = []
+    stores = []
+    for sample in samples:
+        if isinstance(sample, (str, os.PathLike)):
+            store = Lmdb.open(sample)
+            opened.append(store)
+        else:
+            store = sample
         if len(store) < subsample_size:
-            print(f"Warning: Sample '{sample}' only contains {len(store)} sequences. This sample will not be included.")
-            store.close()
+            print(f"Warning: Sample '{store.env.path()}' only contains {len(store)} sequences. This sample will not be included.")
             continue
-        samples.append(store)
+        stores.append(store)
+    samples = stores
     sample_lengths = np.array([len(s) for s in samples])
     rng = rng if rng is not None else np.random.default_rng()
     if balance:
-        sample_lengths = np.min(sample_lengths)
+        sample_lengths[:] = np.min(sample_lengths)
 
-    result = np.empty((len(samples), subsamples_per_sample, subsample_size, sequence_length))
-    augments = rng.uniform(size=result.shape[:-1]) if augment else np.zeros_like(result.shape[:-1])
+    shape = (len(samples), subsamples_per_sample, subsample_size)
+    result = np.empty((*shape, sequence_length), dtype=np.uint8)
+    augments = rng.uniform(size=shape) if augment else np.zeros(shape)
     for i, sample in enumerate(samples):
-        all_indices = np.arange(sample_lengths[i])
-        for j in range(subsamples_per_sample):
-            indices = rng.choice(all_indices, subsample_size, replace=False)
-            for k, sequence_index in enumerate(indices):
-                sequence = sample[str(sequence_index)]
-                offset = int(augments[i,j,k] * (len(sequence) - sequence_length + 1))
-                result[i,j,k] = np.frombuffer(
-                    sequence[offset:sequence_length+offset], dtype=np.uint8)
+        legacy = has_legacy_keys(sample)
+        with sample.env.begin(buffers=True) as txn:
+            cursor = txn.cursor()
+            for j in range(subsamples_per_sample):
+                indices = np.sort(rng.choice(sample_lengths[i], subsample_size, replace=False, shuffle=False))
+                sequences = [sequence for _, sequence in cursor.getmulti(sequence_keys(indices, legacy))]
+                lengths = np.fromiter(map(len, sequences), dtype=int, count=subsample_size)
+                offsets = (augments[i,j] * (lengths - sequence_length + 1)).astype(int)
+                for k, (sequence, offset) in enumerate(zip(sequences, offsets)):
+                    result[i,j,k] = sequence[offset:offset+sequence_length]
+    for store in opened:
+        store.close()
     return result
 
 
@@ -88,11 +223,100 @@ class DnaLabelType(enum.Enum):
 
 def open_lmdb(path, lock=False):
     try:
-        return Lmdb.open(path, lock=lock)
+        return Lmdb.open(path, lock=lock, max_readers=512)
     except:
         return Lmdb.open(path)
 
 
+def post_process_batch_tf(batch, sample_ids, kmer, labels=None):
+    """
+    Encode a batch of sequences into k-mers and attach the requested labels.
+    """
+    kmers = batch_to_kmers_tf(batch, kmer)
+    if labels == DnaLabelType.SampleIds:
+        return kmers, sample_ids
+    elif labels == DnaLabelType.OneMer:
+        return kmers, batch
+    elif labels == DnaLabelType.KMer:
+        return kmers, kmers
+    return kmers
+
+
+def write_tfrecords(stores, path, shard_size=2**27, rng=None):
+    """
+    Write the sequences of the given databases in a random order into TFRecord shards of roughly
+    shard_size bytes. Each example holds the raw sequence bytes and the index of its sample.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    os.makedirs(path, exist_ok=True)
+    sample_ids = np.repeat(np.arange(len(stores)), [len(s) for s in stores])
+    sequence_ids = np.concatenate([np.arange(len(s)) for s in stores])
+    order = rng.permutation(len(sample_ids))
+    legacy = [has_legacy_keys(s) for s in stores]
+    shard, writer, written = 0, None, 0
+    for sample_index, sequence_index in zip(sample_ids[order], sequence_ids[order]):
+        if writer is None or written >= shard_size:
+            if writer is not None:
+                writer.close()
+            writer = tf.io.TFRecordWriter(os.path.join(path, f"shard-{shard:05d}.tfrecord"))
+            shard, written = shard + 1, 0
+        key = sequence_keys([sequence_index], legacy[sample_index])[0]
+        sequence = stores[sample_index][key]
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "sequence": tf.train.Feature(bytes_list=tf.train.BytesList(value=[sequence])),
+            "sample": tf.train.Feature(int64_list=tf.train.Int64List(value=[sample_index]))
+        })).SerializeToString()
+        writer.write(example)
+        written += len(example)
+    if writer is not None:
+        writer.close()
+
+
+def tfrecord_dataset(
+    path,
+    sequence_length,
+    kmer=1,
+    batch_size=32,
+    augment=True,
+    labels=None,
+    shuffle_buffer=2**14
+):
+    """
+    Create an infinite batched tf.data pipeline from TFRecord shards written by write_tfrecords.
+    The shards are read in parallel in a different order on each pass and shuffled through a
+    rolling buffer. Epochs should be delimited with steps_per_epoch so that a single iterator
+    walks the whole dataset across epochs.
+    """
+    features = {
+        "sequence": tf.io.FixedLenFeature([], tf.string),
+        "sample": tf.io.FixedLenFeature([], tf.int64)
+    }
+    def parse(example):
+        example = tf.io.parse_single_example(example, features)
+        sequence = tf.io.decode_raw(example["sequence"], tf.uint8)
+        offset = 0
+        if augment:
+            offset = tf.random.uniform(
+                (), maxval=tf.shape(sequence)[0] - sequence_length + 1, dtype=tf.int32)
+        sequence = tf.ensure_shape(sequence[offset:offset+sequence_length], (sequence_length,))
+        return sequence, tf.cast(example["sample"], tf.int32)
+
+    files = tf.data.Dataset.list_files(os.path.join(path, "*.tfrecord"), shuffle=True)
+    dataset = files.interleave(
+        tf.data.TFRecordDataset,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False)
+    dataset = dataset.repeat().shuffle(shuffle_buffer)
+    dataset = dataset.map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(
+        lambda batch, sample_ids: post_process_batch_tf(batch, sample_ids, kmer, labels),
+        num_parallel_calls=tf.data.AUTOTUNE)
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+
 class DnaSequenceGenerator(keras.utils.Sequence):
     """
     A DNA sequence generator for Keras models
@@ -177,6 +401,9 @@ class DnaSequenceGenerator(keras.utils.Sequence):
         labels=None,
         indices=None,
         rng=None,
+        materialize=False,
+        in_memory=False,
+        memory_map=False,
         _delay_init=False
     ):
         super().__init__()
@@ -190,6 +417,12 @@ class DnaSequenceGenerator(keras.utils.Sequence):
         self.labels = labels
         self.indices = indices
         self.rng = rng if rng is not None else np.random.default_rng()
+        self.materialize = materialize
+        self.in_memory = in_memory or memory_map
+        self.memory_map = memory_map
+        self.epoch_buffer = None
+        self.sequences = None
+        self.__output_signature = None
 
         if not _delay_init:
             self.initialize()
@@ -202,38 +435,37 @@ class DnaSequenceGenerator(keras.utils.Sequence):
             self.indices = [np.arange(len(s)) for s in self.samples]
 
         # The length of each sample
-        self.sample_lengths = np.max(len(i) for i in self.indices)
+        self.sample_lengths = np.array([len(i) for i in self.indices])
 
         # Should we trim the data to balance each sample?
         if self.balance:
             self.sample_lengths[:] = np.min(self.sample_lengths)
 
-        # Sequence augmentation/clipping
-        if self.augment:
-            self.augment_offset_fn = self.compute_augmented_offset
-        else:
-            self.augment_offset_fn = lambda *_: 0
+        # Database key formats
+        self.legacy_keys = [has_legacy_keys(s) for s in self.samples]
 
-        # k-mer encodings
-        if self.kmer > 1:
-            self.kmer_kernel = 5**np.arange(self.kmer)
-            self.to_kmers = lambda x: np.convolve(x, self.kmer_kernel, mode="valid")
-        else:
-            self.to_kmers = lambda x: x
+        # The sequence length of each sample. This is only used to convert the augmentation
+        # factors to integer offsets for the in-memory/contiguous arrays, whose export requires
+        # every sequence of a database to share a fixed length.
+        self._seq_lens = np.empty(self.num_samples, dtype=np.int64)
+        for i in range(self.num_samples):
+            self._seq_lens[i] = min(len(s) for _, s in self.read_sequences(i, self.indices[i][[0, -1]]))
+        self._max_offsets = self._seq_lens - self.sequence_length + 1
+
+        # Hold all sequences in memory
+        if self.in_memory:
+            self.load_sequences()
+
+        # k-mer encodings (warm up the JIT-compiled encoder if available)
+        dna.encode_kmer_batch(np.zeros((1, self.sequence_length), dtype=np.uint8), self.kmer)
 
         # Included label types in the returned batches
-        if self.labels == DnaLabelType.SampleIds:
-            self.post_process_batch = lambda batch, batch_index: (
-                self.batch_to_kmers(batch), self.sample_indices[batch_index])
-        elif self.labels == DnaLabelType.OneMer:
-            self.post_process_batch = lambda batch, batch_index: (self.batch_to_kmers(batch), batch)
-        elif self.labels == DnaLabelType.KMer:
-            self.post_process_batch = lambda batch, _: 2*(self.batch_to_kmers(batch),)
-        else:
-            self.post_process_batch = lambda batch, _: self.batch_to_kmers(batch)
+        self.post_process_batch = self.create_post_process_fn()
 
         # Shuffle the indices
         self.shuffle()
+        if self.materialize:
+            self.epoch_materialize()
 
     def shuffle(self):
         # Full epoch indices shape
@@ -241,46 +473,280 @@ class DnaSequenceGenerator(keras.utils.Sequence):
 
         # Select random samples
         self.sample_indices = self.rng.integers(self.num_samples, size=shape, dtype=np.int32)
-        self.sequence_indices = self.rng.uniform(size=shape) # 0.0 - 1.0
-
-        # Augmented offsets
+        self.sequence_indices = self.rng.integers(self.sample_lengths[self.sample_indices], dtype=np.int64)
+
+        # Augmented clipping positions
+        self.draw_augmentations(shape, self._max_offsets[self.sample_indices])
+
+    def draw_augmentations(self, shape, max_offsets):
+        """
+        Draw the clipping position of every sequence in the epoch as a fraction of its clipping
+        range. Reads from the databases scale the factor by their own length, so variable-length
+        sequences are augmented uniformly; the fixed-length contiguous arrays use the precomputed
+        integer offsets.
+        """
         if self.augment:
-            self.augment_offsets = self.rng.uniform(size=shape)
-
-    def compute_augmented_offset(self, sequence_len, augment_index):
-        offset = self.augment_offsets[augment_index]
-        return int(offset * (sequence_len - self.sequence_length + 1))
-
-    def clip_sequence(self, sequence, offset=0):
-        return sequence[offset:offset+self.sequence_length]
+            self.augment_factors = self.rng.random(shape, dtype=np.float32)
+        else:
+            self.augment_factors = np.zeros(shape, dtype=np.float32)
+        self.augment_offsets = (self.augment_factors * max_offsets).astype(np.int32)
 
     def batch_to_kmers(self, batch):
-        result = np.empty((len(batch), self.sequence_length - self.kmer + 1))
-        for i, sequence in enumerate(batch):
-            result[i] = self.to_kmers(sequence)
-        return result
+        return dna.encode_kmer_batch(batch, self.kmer)
+
+    def create_post_process_fn(self):
+        """
+        Create the batch post-processing function for the configured label type. The k-mer
+        encoder is resolved once here rather than on every batch.
+        """
+        encode = self.batch_to_kmers
+        if self.labels == DnaLabelType.SampleIds:
+            def post_process_batch(batch, batch_index):
+                return encode(batch), self.sample_indices[batch_index]
+        elif self.labels == DnaLabelType.OneMer:
+            def post_process_batch(batch, _):
+                return encode(batch), batch
+        elif self.labels == DnaLabelType.KMer:
+            def post_process_batch(batch, _):
+                kmers = encode(batch)
+                return kmers, kmers
+        else:
+            def post_process_batch(batch, _):
+                return encode(batch)
+        return post_process_batch
 
     def __len__(self):
         return self.batches_per_epoch
 
     def __getitem__(self, batch_index):
-        batch = self.generate_batch(batch_index)
-        return self.post_process_batch(batch, batch_index)
+        return self.post_process_batch(self.generate_batch(batch_index), batch_index)
+
+    def load_sequences(self):
+        """
+        Load the sequences of every sample into a single contiguous (num_sequences, length)
+        array (padded to the longest sequence length) so that a batch can be assembled with a
+        single fancy-index. With memory mapping, each sample is instead kept as a read-only
+        memory-mapped array and the OS pages in only the rows each batch touches.
+        """
+        if self.memory_map:
+            self.sequences = [read_contiguous(s, mmap=True) for s in self.samples]
+        else:
+            with ThreadPoolExecutor(max_workers=min(16, self.num_samples)) as pool:
+                samples = list(pool.map(read_contiguous, self.samples))
+            self.sequences = np.zeros(
+                (sum(len(s) for s in samples), max(s.shape[1] for s in samples)),
+                dtype=np.uint8)
+            self.sequence_bases = np.cumsum([0] + [len(s) for s in samples[:-1]])
+            for base, sequences in zip(self.sequence_bases, samples):
+                self.sequences[base:base+len(sequences),:sequences.shape[1]] = sequences
+
+        # The available sequence indices of all samples, flattened
+        self.flat_indices = np.concatenate(self.indices)
+        self.index_bases = np.cumsum([0] + [len(i) for i in self.indices[:-1]])
+
+    def batch_sequence_indices(self, batch_index):
+        """
+        The database sequence indices making up the given batch.
+        """
+        sample_indices = self.sample_indices[batch_index]
+        positions = self.index_bases[sample_indices] + self.sequence_indices[batch_index]
+        return self.flat_indices[positions]
+
+    def batch_rows(self, batch_index):
+        """
+        The rows of the in-memory sequence array making up the given batch.
+        """
+        bases = self.sequence_bases[self.sample_indices[batch_index]]
+        sequence_indices = self.batch_sequence_indices(batch_index)
+        bases = bases.reshape(bases.shape + (1,)*(sequence_indices.ndim - bases.ndim))
+        return bases + sequence_indices
+
+    def gather_batch(self, batch_index):
+        """
+        Assemble a batch from the in-memory sequence array, or from the memory-mapped arrays
+        of each sample.
+        """
+        offsets = self.augment_offsets[batch_index]
+        columns = offsets[...,np.newaxis] + np.arange(self.sequence_length)
+        if not self.memory_map:
+            rows = self.batch_rows(batch_index)
+            return self.sequences[rows[...,np.newaxis], columns]
+        sample_indices = self.sample_indices[batch_index]
+        sequence_indices = self.batch_sequence_indices(batch_index)
+        batch = np.empty(self.batch_shape(), dtype=np.uint8)
+        for sample_index in np.unique(sample_indices):
+            mask = sample_indices == sample_index
+            rows = sequence_indices[mask][...,np.newaxis]
+            batch[mask] = self.sequences[sample_index][rows, columns[mask]]
+        return batch
 
-    def generate_batch(self, batch_index):
-        batch = np.empty((self.batch_size, self.sequence_length), dtype=np.int32)
+    def read_sequences(self, sample_index, sequence_indices):
+        """
+        Read the given sequences from a sample in key order using a single transaction and cursor.
+        Yields (position, sequence) pairs; each sequence buffer is only valid during iteration.
+        """
+        order = np.argsort(sequence_indices)
+        keys = sequence_keys(np.asarray(sequence_indices)[order], self.legacy_keys[sample_index])
+        with self.samples[sample_index].env.begin(buffers=True) as txn:
+            items = txn.cursor().getmulti(keys)
+            for i, (_, sequence) in zip(order, items):
+                yield i, sequence
+
+    def batch_sequences(self, batch_index):
+        """
+        Group the sequences of a batch by sample. Yields (sample_index, rows, sequence_indices).
+        """
         sample_indices = self.sample_indices[batch_index]
         sequence_indices = self.sequence_indices[batch_index]
-        for i in range(self.batch_size):
-            sample_index = sample_indices[i]
-            sequence_index = np.floor(len(self.indices[sample_index])*sequence_indices[i]).astype(int)
-            sequence = self.samples[sample_indices[i]][str(sequence_index).encode()]
-            offset = self.augment_offset_fn(len(sequence), augment_index=(batch_index, i))
-            batch[i] = np.frombuffer(self.clip_sequence(sequence, offset), dtype=np.uint8)
+        for sample_index in np.unique(sample_indices):
+            rows = np.flatnonzero(sample_indices == sample_index)
+            indices = self.indices[sample_index]
+            yield sample_index, rows, indices[sequence_indices[rows]]
+
+    def epoch_sequences(self):
+        """
+        The sample and sequence indices of every sequence in the epoch, flattened in batch order.
+        """
+        sample_ids = self.sample_indices.ravel()
+        positions = self.sequence_indices.ravel()
+        sequence_indices = np.empty(len(sample_ids), dtype=np.int64)
+        for sample_index, indices in enumerate(self.indices):
+            mask = sample_ids == sample_index
+            sequence_indices[mask] = indices[positions[mask]]
+        return sample_ids, sequence_indices
+
+    def epoch_materialize(self):
+        """
+        Read every sequence of the epoch into a preallocated buffer using a single sorted cursor
+        pass per sample, so generating a batch is reduced to a slice.
+        """
+        sample_ids, sequence_indices = self.epoch_sequences()
+        shape = self.sequence_indices.shape + (self.sequence_length,)
+        if self.epoch_buffer is None or self.epoch_buffer.shape != shape:
+            self.epoch_buffer = np.empty(shape, dtype=np.uint8)
+        buffer = self.epoch_buffer.reshape((-1, self.sequence_length))
+        factors = self.augment_factors.ravel()
+        length = self.sequence_length
+        for sample_index in range(self.num_samples):
+            positions = np.flatnonzero(sample_ids == sample_index)
+            for j, sequence in self.read_sequences(sample_index, sequence_indices[positions]):
+                p = positions[j]
+                offset = int(factors[p] * (len(sequence) - length + 1))
+                buffer[p] = sequence[offset:offset+length]
+
+    def generate_batch(self, batch_index):
+        if self.materialize:
+            return self.epoch_buffer[batch_index].copy()
+        if self.in_memory:
+            return self.gather_batch(batch_index)
+        batch = np.empty((self.batch_size, self.sequence_length), dtype=np.uint8)
+        factors = self.augment_factors[batch_index]
+        length = self.sequence_length
+        for sample_index, rows, sequence_indices in self.batch_sequences(batch_index):
+            for j, sequence in self.read_sequences(sample_index, sequence_indices):
+                i = rows[j]
+                offset = int(factors[i] * (len(sequence) - length + 1))
+                batch[i] = sequence[offset:offset+length]
         return batch
 
     def on_epoch_end(self):
         self.shuffle()
+        if self.materialize:
+            self.epoch_materialize()
+
+    def output_signature(self):
+        """
+        The tensor specifications of the raw batches (and their sample IDs) fed into tf.data,
+        declared from the batch shape rather than by generating a batch.
+        """
+        if self.__output_signature is None:
+            self.__output_signature = (
+                tf.TensorSpec(self.batch_shape(), tf.uint8),
+                tf.TensorSpec((self.batch_size,), tf.int32))
+        return self.__output_signature
+
+    def batch_shape(self):
+        return (self.batch_size, self.sequence_length)
+
+    def post_process_batch_tf(self, batch, sample_ids):
+        """
+        The tf.data equivalent of post_process_batch.
+        """
+        return post_process_batch_tf(batch, sample_ids, self.kmer, self.labels)
+
+    def to_tf_dataset(self, contiguous=False):
+        """
+        Wrap the generator in a tf.data pipeline so that batches are produced in parallel and
+        prefetched while the model trains on the current batch. The epoch is reshuffled each time
+        the dataset is iterated, and k-mer encoding is performed by a vectorized TF map.
+
+        If contiguous is set, the decoded sequences of the databases are loaded whole from their
+        contiguous sequence files (see export_contiguous), and each epoch's random batches and
+        augmentation crops are gathered from them by TF ops rather than read by Python generators.
+        """
+        if contiguous:
+            dataset = self.__contiguous_batches()
+        else:
+            dataset = self.__generated_batches()
+        dataset = dataset.map(self.post_process_batch_tf, num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(len(self)))
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        # Fuse the batch gather and k-mer encoding maps into a single function
+        options.experimental_optimization.map_fusion = True
+        options.experimental_optimization.map_and_batch_fusion = True
+        return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+    def __generated_batches(self):
+        signature = self.output_signature()
+        batch_generator = self.__batch_generator
+        dataset = tf.data.Dataset.from_generator(
+            self.__epoch_batch_indices,
+            output_signature=tf.TensorSpec((), dtype=tf.int64))
+        return dataset.interleave(
+            lambda batch_index: tf.data.Dataset.from_generator(
+                batch_generator,
+                args=(batch_index,),
+                output_signature=signature),
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=False)
+
+    def __contiguous_batches(self):
+        # Stack the samples into a single tensor, padding to the longest sequence length
+        with ThreadPoolExecutor(max_workers=min(16, self.num_samples)) as pool:
+            samples = list(pool.map(load_contiguous, self.samples))
+        width = max(s.shape[1] for s in samples)
+        sequences = tf.concat([tf.pad(s, ((0, 0), (0, width - s.shape[1]))) for s in samples], 0)
+        bases = np.cumsum([0] + [s.shape[0] for s in samples[:-1]])
+
+        # The epoch's rows/offsets are produced once per epoch and sliced into batches
+        shape = self.augment_offsets.shape
+        epoch_rows = lambda: self.__epoch_rows(bases)
+        dataset = tf.data.Dataset.from_generator(epoch_rows, output_signature=(
+            tf.TensorSpec(shape, tf.int64),
+            tf.TensorSpec(shape, tf.int32),
+            tf.TensorSpec(self.sample_indices.shape, tf.int32)))
+        dataset = dataset.flat_map(lambda *epoch: tf.data.Dataset.from_tensor_slices(epoch))
+
+        length = self.sequence_length
+        def gather_batch(rows, offsets, sample_ids):
+            positions = offsets[...,tf.newaxis] + tf.range(length, dtype=tf.int32)
+            batch = tf.gather(tf.gather(sequences, rows), positions, batch_dims=len(shape) - 1)
+            return batch, sample_ids
+        return dataset.map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE)
+
+    def __epoch_rows(self, bases):
+        self.shuffle()
+        sample_ids, sequence_indices = self.epoch_sequences()
+        rows = (bases[sample_ids] + sequence_indices).reshape(self.augment_offsets.shape)
+        yield rows, self.augment_offsets, self.sample_indices
+
+    def __epoch_batch_indices(self):
+        self.on_epoch_end()
+        yield from range(len(self))
+
+    def __batch_generator(self, batch_index):
+        yield self.generate_batch(batch_index), self.sample_indices[batch_index]
 
     def __del__(self):
         for sample in self.samples:
@@ -349,9 +815,15 @@ class DnaSampleGenerator(DnaSequenceGenerator):
         labels=None,
         indices=None,
         rng=None,
+        materialize=False,
+        in_memory=False,
+        memory_map=False,
+        fill_workers=16,
         _delay_init=True
     ):
         self.subsample_length = subsample_length
+        self.fill_workers = min(fill_workers, batch_size)
+        self.__fill_pool = None
         self.sequence_indices = np.empty(
             (batches_per_epoch, batch_size, subsample_length),
             dtype=np.int32)
@@ -367,8 +839,16 @@ class DnaSampleGenerator(DnaSequenceGenerator):
             labels=labels,
             indices=indices,
             rng=rng,
+            materialize=materialize,
+            in_memory=in_memory,
+            memory_map=memory_map,
             _delay_init=_delay_init)
 
+    def initialize(self):
+        super().initialize()
+        # Each subsample is read in its own read transaction, so the fills can run concurrently
+        if self.fill_workers > 1 and self.__fill_pool is None:
+            self.__fill_pool = ThreadPoolExecutor(max_workers=self.fill_workers)
 
     def shuffle(self):
         self.sample_indices = self.rng.integers(
@@ -376,35 +856,66 @@ class DnaSampleGenerator(DnaSequenceGenerator):
             size=(self.batches_per_epoch, self.batch_size),
             dtype=np.int32)
 
-        for i in range(self.batches_per_epoch):
-            for j in range(self.batch_size):
-                sample_id = self.sample_indices[i,j]
-                self.sequence_indices[i,j] = self.rng.choice(
-                    self.indices[sample_id],
-                    self.subsample_length,
-                    replace=False)
+        # Draw the subsample positions for every cell at once, then map them to sequence indices
+        lengths = np.array([len(i) for i in self.indices])[self.sample_indices]
+        positions = sample_without_replacement(lengths.ravel(), self.subsample_length, self.rng)
+        positions = positions.reshape(self.sequence_indices.shape)
+        for sample_id, indices in enumerate(self.indices):
+            mask = self.sample_indices == sample_id
+            self.sequence_indices[mask] = indices[positions[mask]]
 
-        # Augmented offsets
-        if self.augment:
-            self.augment_offsets = self.rng.uniform(
-                size=(self.batches_per_epoch, self.batch_size, self.subsample_length))
+        # Augmented clipping positions
+        self.draw_augmentations(
+            self.sequence_indices.shape,
+            self._max_offsets[self.sample_indices][...,np.newaxis])
 
-    def batch_to_kmers(self, batch):
-        result = np.empty((len(batch), self.subsample_length, self.sequence_length - self.kmer + 1))
-        for i, subsample in enumerate(batch):
-            result[i] = super().batch_to_kmers(subsample)
-        return result
+    def batch_sequences(self, batch_index):
+        sample_indices = self.sample_indices[batch_index]
+        sequence_indices = self.sequence_indices[batch_index]
+        for i in range(self.batch_size):
+            yield sample_indices[i], i, sequence_indices[i]
+
+    def epoch_sequences(self):
+        sample_ids = np.repeat(self.sample_indices.ravel(), self.subsample_length)
+        return sample_ids, self.sequence_indices.ravel()
+
+    def batch_sequence_indices(self, batch_index):
+        return self.sequence_indices[batch_index]
+
+    def batch_shape(self):
+        return (self.batch_size, self.subsample_length, self.sequence_length)
 
     def generate_batch(self, batch_index):
+        if self.materialize:
+            return self.epoch_buffer[batch_index].copy()
+        if self.in_memory:
+            return self.gather_batch(batch_index)
         batch = np.empty(
             (self.batch_size, self.subsample_length, self.sequence_length),
-            dtype=np.int32)
-        sample_indices = self.sample_indices[batch_index]
-        sequence_indices = self.sequence_indices[batch_index]
-        for i in range(self.batch_size):
-            sample = self.samples[sample_indices[i]]
-            for j in range(self.subsample_length):
-                sequence = sample[str(sequence_indices[i,j]).encode()]
-                offset = self.augment_offset_fn(len(sequence), (batch_index, i, j))
-                batch[i,j] = np.frombuffer(self.clip_sequence(sequence, offset), dtype=np.uint8)
+            dtype=np.uint8)
+        factors = self.augment_factors[batch_index]
+        if self.fill_workers <= 1:
+            for sample_index, i, sequence_indices in self.batch_sequences(batch_index):
+                self.fill_subsample(batch[i], sample_index, sequence_indices, factors[i])
+            return batch
+        futures = [
+            self.__fill_pool.submit(
+                self.fill_subsample, batch[i], sample_index, sequence_indices, factors[i])
+            for sample_index, i, sequence_indices in self.batch_sequences(batch_index)]
+        for future in futures:
+            future.result()
         return batch
+
+    def fill_subsample(self, out, sample_index, sequence_indices, factors):
+        """
+        Read and clip the sequences of a single subsample into the given output rows.
+        """
+        length = self.sequence_length
+        for j, sequence in self.read_sequences(sample_index, sequence_indices):
+            offset = int(factors[j] * (len(sequence) - length + 1))
+            out[j] = sequence[offset:offset+length]
+
+    def __del__(self):
+        if self.__fill_pool is not None:
+            self.__fill_pool.shutdown(wait=True)
+        super().__del__()
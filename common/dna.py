@@ -1,24 +1,34 @@
 import numpy as np
 from . utils import static_vars
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 BASES = "ACGTN"
 
 # General DNA Utilities ----------------------------------------------------------------------------
 
-@static_vars(m = {c: i for i, c in enumerate(BASES)})
+@static_vars(m = np.array([BASES.find(chr(c)) for c in range(256)]).astype(np.uint8)) # 255 = invalid
 def encode_sequence(sequence: str):
     """
     Encode a DNA sequence into an integer vector representation.
     """
-    return np.array([encode_sequence.m[base] for base in sequence], dtype=np.uint8)
+    if isinstance(sequence, str):
+        sequence = sequence.encode()
+    result = encode_sequence.m[np.frombuffer(sequence, dtype=np.uint8)]
+    if np.any(result == 255):
+        raise KeyError(f"Invalid base in sequence: {sequence}")
+    return result
 
 
-@static_vars(m = [c for c in BASES])
+@static_vars(m = np.frombuffer(BASES.encode(), dtype=np.uint8))
 def decode_sequence(sequence: list):
     """
     Decode a DNA sequence integer vector representation into a string of bases.
     """
-    return ''.join(decode_sequence.m[base] for base in sequence)
+    return decode_sequence.m[np.asarray(sequence)].tobytes().decode()
 
 
 def encode_kmers(encoded_sequence: list, kmer):
@@ -28,6 +38,46 @@ def encode_kmers(encoded_sequence: list, kmer):
     return np.convolve(encoded_sequence, 5**np.arange(kmer), mode="valid")
 
 
+def kmer_dtype(kmer):
+    """
+    The smallest integer type able to hold the kmer identifiers (int16 for kmer <= 6).
+    """
+    return np.int16 if 5**kmer < 2**15 else np.int32
+
+
+def encode_kmer_batch(batch, kmer, out=None):
+    """
+    Encode a batch of sequence vector representations (along the last axis) as kmers. Uses a
+    parallel JIT-compiled rolling encoder when Numba is available.
+    """
+    dtype = kmer_dtype(kmer)
+    if numba is None:
+        kernel = 5**np.arange(kmer - 1, -1, -1, dtype=dtype)
+        return np.lib.stride_tricks.sliding_window_view(batch, kmer, axis=-1).dot(kernel)
+    shape = batch.shape[:-1] + (batch.shape[-1] - kmer + 1,)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    _encode_kmer_rows(
+        batch.reshape((-1, batch.shape[-1])),
+        kmer,
+        out.reshape((-1, shape[-1])))
+    return out
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _encode_kmer_rows(batch, kmer, out):
+        high = 5**(kmer - 1)
+        for i in numba.prange(batch.shape[0]):
+            h = 0
+            for j in range(kmer):
+                h = h*5 + batch[i,j]
+            out[i,0] = h
+            for j in range(kmer, batch.shape[1]):
+                h = (h - batch[i,j-kmer]*high)*5 + batch[i,j]
+                out[i,j-kmer+1] = h
+
+
 def decode_kmers(kmer_sequence, kmer):
     """
     Decode a kmer sequence vector representation.
@@ -49,7 +99,7 @@ def encode_phred(probs, encoding=33):
 
 
 def decode_phred(quality_str, encoding=33):
-    scores = np.array([(ord(token) - encoding) for token in quality_str])
+    scores = np.frombuffer(quality_str.encode(), dtype=np.uint8).astype(int) - encoding
     return 10**(scores / -10)
 
 
@@ -16,7 +16,7 @@ def to_encoded_dict(entries, encoding=33):
     for i, entry in enumerate(entries):
         sequence = dna.encode_sequence(entry.sequence)
         scores = dna.decode_phred(entry.quality_scores, encoding=encoding)
-        result[f"{i}".encode()] = sequence.tobytes()
+        result[i.to_bytes(8, "big")] = sequence.tobytes()
         # result[f"{i}_scores".encode()] = scores.tobytes()
     return result
 
@@ -390,6 +390,8 @@ class EmbeddingWithClassToken(keras.layers.Layer):
         self.embedding = keras.layers.Embedding(num_tokens + 1, embed_dim, mask_zero=mask_zero)
 
     def call(self, inputs):
+        # k-mer identifiers may be supplied as int16
+        inputs = tf.cast(inputs, dtype=self.token_id.dtype)
         token = tf.tile(self.token_id, (tf.shape(inputs)[0], 1))
         return self.embedding(tf.concat([token, inputs], axis=1))
 
@@ -1,7 +1,7 @@
 import tensorflow as tf
 import tensorflow.keras as keras
 from .. core.custom_objects import CustomObject
-from .. utils import load_model, accumulate_train_step
+from .. utils import load_model, accumulate_train_step, scale_loss, unscale_gradients
 
 class CustomModel(keras.Model):
     
@@ -32,7 +32,9 @@ class CustomModel(keras.Model):
             with tf.GradientTape() as tape:
                 y_pred = self(x, training=True)
                 loss = self.compiled_loss(y, y_pred, regularization_losses=self.losses)
+                loss = scale_loss(self.optimizer, loss)
             grads = tape.gradient(loss, self.trainable_weights)
+            grads = unscale_gradients(self.optimizer, grads)
             self.compiled_metrics.update_state(y, y_pred)
             
             return [], [grads]
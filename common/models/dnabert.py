@@ -69,7 +69,7 @@ class DnaBertPretrainModel(CustomModel):
         y = self.base(y)
         _, y = SplitClassToken()(y)
         y = InvertMask()(y)
-        y = keras.layers.Dense(5**self.base.kmer)(y)
+        y = keras.layers.Dense(5**self.base.kmer, dtype="float32")(y)
         return keras.Model(x, y)
 
     def compile(self, **kwargs):
@@ -148,7 +148,7 @@ class DnaBertDecoderModel(CustomModel):
                                         num_heads=self.num_heads,
                                         ff_dim=self.embed_dim,
                                         prenorm=self.pre_layernorm)(y)
-        y = keras.layers.Dense(5, activation="softmax")(y)
+        y = keras.layers.Dense(5, activation="softmax", dtype="float32")(y)
         return keras.Model(x, y)
 
     def call(self, inputs, training=None):
@@ -180,10 +180,11 @@ class DnaBertAutoencoderModel(CustomModel):
         self.encoder = encoder
         self.decoder = decoder
 
-    def compile(self, **kwargs):
+    def compile(self, jit_compile=True, **kwargs):
         if "loss" not in kwargs:
             kwargs["loss"] = keras.losses.SparseCategoricalCrossentropy(from_logits=False)
-        super().compile(**kwargs)
+        # XLA-compile the training step so the transformer blocks are fused
+        super().compile(jit_compile=jit_compile, **kwargs)
 
     def call(self, inputs, training=None):
         encoded = self.encoder(inputs, training=training)
@@ -3,7 +3,7 @@ import tensorflow.keras as keras
 
 from common.core.custom_objects import CustomObject
 from common.models import CustomModel
-from common.utils import accumulate_train_step
+from common.utils import accumulate_train_step, loss_scale_optimizer, scale_loss, unscale_gradients
 
 # Interfaces ---------------------------------------------------------------------------------------
 
@@ -48,12 +48,15 @@ class Gan(CustomModel):
         generator_metrics=[],
         discriminator_metrics=[],
         force_build=True,
+        jit_compile=False,
         **kwargs
     ):
-        super().compile(**kwargs)
+        # Optionally XLA-compile the training step. Generators that draw random set sizes (e.g.
+        # GAST's SampleSet) cannot be compiled since XLA requires static shapes.
+        super().compile(jit_compile=jit_compile, **kwargs)
         self.loss_obj = loss
-        self.g_optimizer = generator_optimizer
-        self.d_optimizer = discriminator_optimizer
+        self.g_optimizer = loss_scale_optimizer(generator_optimizer)
+        self.d_optimizer = loss_scale_optimizer(discriminator_optimizer)
         self.g_metrics = generator_metrics
         self.d_metrics = discriminator_metrics
         self.g_loss = keras.metrics.Mean("generator_loss")
@@ -107,7 +110,8 @@ class Gan(CustomModel):
         # Sample the latent space for the generator
         generator_input = self.generate_generator_input(batch_size)
 
-        with tf.GradientTape() as g_tape, tf.GradientTape() as d_tape:
+        # A single persistent tape records the forward pass once for both gradients
+        with tf.GradientTape(persistent=True) as tape:
             fake_data = self.generator(generator_input, training=True)
 
             real_output = self.discriminator(real_input, training=True)
@@ -115,10 +119,15 @@ class Gan(CustomModel):
 
             g_loss, d_loss, metrics = self.compute_metrics(
                 data, generator_input, real_output, fake_output)
+            g_loss = scale_loss(self.g_optimizer, g_loss)
+            d_loss = scale_loss(self.d_optimizer, d_loss)
 
         # Update gradients
-        g_grads = g_tape.gradient(g_loss, self.generator.trainable_variables)
-        d_grads = d_tape.gradient(d_loss, self.discriminator.trainable_variables)
+        g_grads = tape.gradient(g_loss, self.generator.trainable_variables)
+        d_grads = tape.gradient(d_loss, self.discriminator.trainable_variables)
+        del tape
+        g_grads = unscale_gradients(self.g_optimizer, g_grads)
+        d_grads = unscale_gradients(self.d_optimizer, d_grads)
         self.g_optimizer.apply_gradients(zip(g_grads, self.generator.trainable_variables))
         self.d_optimizer.apply_gradients(zip(d_grads, self.discriminator.trainable_variables))
 
@@ -126,12 +135,15 @@ class Gan(CustomModel):
 
     def compute_metrics_for_component(self, y_true, y_pred, loss_fn, loss_metric, metrics):
         """
-        Compute the loss and update the metrics for a component model.
+        Compute the loss and update the metrics for a component model. The targets/predictions may
+        be given as tuples of (real, fake) halves.
         """
         loss = tf.reduce_mean(loss_fn(y_true, y_pred))
         loss_metric.update_state(loss)
+        pairs = tuple(zip(y_true, y_pred)) if type(y_true) is tuple else ((y_true, y_pred),)
         for metric in metrics:
-            metric.update_state(y_true, y_pred)
+            for t, p in pairs:
+                metric.update_state(t, p)
         return loss
 
     def compute_metrics(self, data, gen_input, real_output, fake_output):
@@ -169,10 +181,11 @@ class Gan(CustomModel):
 
     def discriminator_metric_args(self, data, real_output, fake_output):
         """
-        Compute the y_true and y_pred loss/metric arguments for the discriminator
+        Compute the y_true and y_pred loss/metric arguments for the discriminator as (real, fake)
+        halves
         """
-        y_true = tf.concat((tf.ones_like(real_output), tf.zeros_like(fake_output)), axis=0)
-        y_pred = tf.concat((real_output, fake_output), axis=0)
+        y_true = (tf.ones_like(real_output), tf.zeros_like(fake_output))
+        y_pred = (real_output, fake_output)
         return y_true, y_pred
 
     def generator_loss(self, y_true, y_pred):
@@ -184,10 +197,17 @@ class Gan(CustomModel):
 
     def discriminator_loss(self, y_true, y_pred):
         """
-        Compute the loss for the discriminator
+        Compute the loss for the discriminator from the (real, fake) halves. This is equivalent to
+        computing the loss over the concatenated halves without materializing the concatenation.
         """
-        batch_size = tf.shape(y_true)[0]
-        return self.loss_obj(y_true, y_pred) / tf.cast(batch_size, dtype=tf.float32)
+        (real_true, fake_true), (real_pred, fake_pred) = y_true, y_pred
+        batch_size = tf.shape(real_true)[0] + tf.shape(fake_true)[0]
+        real_loss = tf.reduce_mean(self.loss_obj(real_true, real_pred))
+        fake_loss = tf.reduce_mean(self.loss_obj(fake_true, fake_pred))
+        loss = real_loss + fake_loss
+        if getattr(self.loss_obj, "reduction", None) != keras.losses.Reduction.SUM:
+            loss *= 0.5 # the halves are always the same size
+        return loss / tf.cast(batch_size, dtype=tf.float32)
 
     def get_config(self):
         config = super().get_config()
@@ -234,8 +254,8 @@ class ConditionalGan(Gan):
         Compute the y_true and y_pred loss/metric arguments for the conditional discriminator
         """
         batch_size = tf.shape(fake_output)[0]
-        y_true = tf.concat((data[-1], tf.fill((batch_size,), self.discriminator.gan_num_classes)), axis=0)
-        y_pred = tf.concat((real_output, fake_output), axis=0)
+        y_true = (data[-1], tf.fill((batch_size,), self.discriminator.gan_num_classes))
+        y_pred = (real_output, fake_output)
         return y_true, y_pred
 
 
@@ -254,9 +274,10 @@ class VeeGan(Gan):
         generator_metrics=[],
         discriminator_metrics=[],
         force_build=True,
+        jit_compile=False,
         **kwargs
     ):
-        self.r_optimizer = reconstructor_optimizer
+        self.r_optimizer = loss_scale_optimizer(reconstructor_optimizer)
         super().compile(
             loss, # Sent to the loss object constructor
             generator_optimizer,
@@ -264,6 +285,7 @@ class VeeGan(Gan):
             generator_metrics,
             discriminator_metrics,
             force_build,
+            jit_compile,
             **kwargs)
 
     def force_build(self):
@@ -303,7 +325,8 @@ class VeeGan(Gan):
         # Sample the latent space for the generator
         fake_input = self.generate_generator_input(batch_size)
 
-        with tf.GradientTape() as g_tape, tf.GradientTape() as r_tape, tf.GradientTape() as d_tape:
+        # A single persistent tape records the forward pass once for all three gradients
+        with tf.GradientTape(persistent=True) as tape:
             fake_data = self.generator(fake_input, training=True)
             real_input = tf.stop_gradient(self.reconstructor(encoded_data, training=True))
 
@@ -315,11 +338,18 @@ class VeeGan(Gan):
 
             g_loss, r_loss, d_loss = self.compute_metrics(
                 data, fake_input, real_input, fake_output, real_output, recon_output)
+            g_loss = scale_loss(self.g_optimizer, g_loss)
+            r_loss = scale_loss(self.r_optimizer, r_loss)
+            d_loss = scale_loss(self.d_optimizer, d_loss)
 
         # Update gradients
-        g_grads = g_tape.gradient(g_loss, self.generator.trainable_variables)
-        r_grads = r_tape.gradient(r_loss, self.reconstructor.trainable_variables)
-        d_grads = d_tape.gradient(d_loss, self.discriminator.trainable_variables)
+        g_grads = tape.gradient(g_loss, self.generator.trainable_variables)
+        r_grads = tape.gradient(r_loss, self.reconstructor.trainable_variables)
+        d_grads = tape.gradient(d_loss, self.discriminator.trainable_variables)
+        del tape
+        g_grads = unscale_gradients(self.g_optimizer, g_grads)
+        r_grads = unscale_gradients(self.r_optimizer, r_grads)
+        d_grads = unscale_gradients(self.d_optimizer, d_grads)
         
         return [], [g_grads, r_grads, d_grads]
         
@@ -414,6 +444,6 @@ class ConditionalVeeGan(VeeGan):
         Compute the y_true and y_pred loss/metric arguments for the conditional discriminator
         """
         batch_size = tf.shape(fake_output)[0]
-        y_true = tf.concat((data[-1], tf.fill((batch_size,), self.discriminator.gan_num_classes)), axis=0)
-        y_pred = tf.concat((real_output, fake_output), axis=0)
+        y_true = (data[-1], tf.fill((batch_size,), self.discriminator.gan_num_classes))
+        y_pred = (real_output, fake_output)
         return y_true, y_pred
\ No newline at end of file
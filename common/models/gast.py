@@ -228,9 +228,9 @@ class GastDiscriminator(CustomModel, IConditionalGanComponent):
 
         # If only one class, use real/fake scheme
         if self.num_classes == 1:
-            y = keras.layers.Dense(1)(y)
+            y = keras.layers.Dense(1, dtype="float32")(y)
         else:
-            y = keras.layers.Dense(self.num_classes + 1)(y)
+            y = keras.layers.Dense(self.num_classes + 1, dtype="float32")(y)
         return keras.Model(x, y)
 
     def call(self, inputs, training=None):
@@ -487,9 +487,9 @@ class VeeGastDiscriminator(CustomModel, IConditionalGanComponent):
 
         # If only one class, use real/fake scheme
         if self.num_classes == 1:
-            y = keras.layers.Dense(1)(y)
+            y = keras.layers.Dense(1, dtype="float32")(y)
         else:
-            y = keras.layers.Dense(self.num_classes + 1)(y)
+            y = keras.layers.Dense(self.num_classes + 1, dtype="float32")(y)
         return keras.Model((noise, data), y)
 
     def call(self, inputs, training=None):
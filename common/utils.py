@@ -25,6 +25,32 @@ def plt_to_image(plt, format="png"):
     buf.seek(0)
     return Image.open(buf)
 
+def loss_scale_optimizer(optimizer):
+    """
+    Wrap the optimizer for dynamic loss scaling if the global policy is mixed_float16.
+    """
+    if optimizer is None or isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+        return optimizer
+    if keras.mixed_precision.global_policy().name != "mixed_float16":
+        return optimizer
+    return keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+def scale_loss(optimizer, loss):
+    """
+    Scale the loss if the optimizer performs mixed-precision loss scaling.
+    """
+    if isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_scaled_loss(loss)
+    return loss
+
+def unscale_gradients(optimizer, grads):
+    """
+    Unscale the gradients if the optimizer performs mixed-precision loss scaling.
+    """
+    if isinstance(optimizer, keras.mixed_precision.LossScaleOptimizer):
+        return optimizer.get_unscaled_gradients(grads)
+    return grads
+
 def accumulate(a, b):
     if type(a) in (list, tuple):
         return [accumulate(x, y) for x, y in zip(a, b)]
@@ -56,9 +82,22 @@ def accumulate_train_step(train_step, batch, subbatch_size, models):
     
     train_step should return a list of variables, followed by a list of gradients
     """
+    # When the batch divides evenly, split it along a new leading axis so that each sub-batch
+    # has a static shape and XLA compiles a single step
+    static_batch_size = batch[0].shape[0]
+    split = isinstance(subbatch_size, int) and static_batch_size is not None \
+        and static_batch_size % subbatch_size == 0
+    if split:
+        subbatches = tuple(
+            tf.reshape(x, (static_batch_size // subbatch_size, subbatch_size) + tuple(x.shape[1:]))
+            for x in batch[:2])
+
     def step(i, accum_variables=None, accum_grads=None):
         n = i + subbatch_size
-        subbatch = (batch[0][i:n], batch[1][i:n])
+        if split:
+            subbatch = tuple(x[i // subbatch_size] for x in subbatches)
+        else:
+            subbatch = (batch[0][i:n], batch[1][i:n])
         
         # Perform training step
         variables, grads = train_step(subbatch)
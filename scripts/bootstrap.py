@@ -49,6 +49,7 @@ class CliArgumentFactory:
         self.argument("--data-workers", type=int, default=data_workers)
         self.argument("--run-eagerly", action="store_true", default=False)
         self.argument("--use-dynamic-memory", action="store_true", default=False)
+        self.argument("--mixed-precision", type=str, choices=["mixed_float16", "mixed_bfloat16"], default=None)
 
     def use_wandb(self, allow_resume=True):
         self.job_argument("--wandb-project", type=str, default=None, help="W&B project name")
@@ -155,10 +156,50 @@ def init(argv, arg_defs):
     return config
 
 
+def init_horovod(config):
+    """
+    Initialize Horovod if requested, pinning each worker process to a single local GPU.
+    """
+    if not getattr(config, "horovod", False):
+        return None
+    import horovod.tensorflow.keras as hvd
+    hvd.init()
+    gpus = tf.config.list_physical_devices("GPU")
+    if len(gpus) > 0:
+        tf.config.experimental.set_visible_devices(gpus[hvd.local_rank()], "GPU")
+    # Give each worker a distinct random stream so they draw different batches
+    if "seed" in __session:
+        __session["next_seed"] += hvd.rank() << 16
+    __session["horovod"] = hvd
+    return hvd
+
+
+def horovod():
+    """
+    The Horovod module if it has been initialized, otherwise None.
+    """
+    return __session.get("horovod")
+
+
+def is_primary_worker():
+    return horovod() is None or horovod().rank() == 0
+
+
+def barrier():
+    """
+    Block until every Horovod worker has reached this point.
+    """
+    if horovod() is not None:
+        horovod().allreduce(tf.constant(0), name="barrier")
+
+
 @utils.static_vars(instance=None)
 def strategy(config):
     if strategy.instance is None:
-        if config.gpus is None:
+        if horovod() is not None:
+            # Horovod runs one process per GPU and performs its own gradient aggregation
+            strategy.instance = tf.distribute.get_strategy()
+        elif config.gpus is None:
             print("Using CPU Strategy")
             strategy.instance = tfu.strategy.cpu()
         else:
@@ -286,6 +327,20 @@ def random_seed(seed):
     keras.utils.set_random_seed(seed)
 
 
+def mixed_precision(config):
+    if getattr(config, "mixed_precision", None) is None:
+        return
+    keras.mixed_precision.set_global_policy(config.mixed_precision)
+
+
+def update_config(values):
+    """
+    Record values changed in the configuration after it was logged to W&B.
+    """
+    if is_using_wandb():
+        wandb_run().config.update(values, allow_val_change=True)
+
+
 def rng():
     seed = None
     if "seed" in __session:
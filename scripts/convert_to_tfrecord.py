@@ -0,0 +1,43 @@
+"""
+Convert the LMDB sample databases of a dataset into shuffled TFRecord shards. The shards for each
+directory of databases are written to a "tfrecords" folder within that directory, where the
+training scripts will pick them up in place of the databases.
+"""
+
+import os
+import sys
+
+import bootstrap
+
+from common.data import find_dbs, open_lmdb, write_tfrecords
+
+
+def define_arguments(cli):
+    cli.artifact("--dataset", type=str, required=True)
+    cli.argument("--shard-size", type=int, default=2**27, help="Approximate shard size in bytes")
+    cli.argument("--seed", type=int, default=None)
+
+
+def main(argv):
+    config = bootstrap.init(argv[1:], define_arguments)
+
+    # Set the random seed
+    bootstrap.random_seed(config.seed)
+
+    # Group the databases by their containing directory (i.e. the dataset split)
+    datadir = bootstrap.artifact(config, "dataset")
+    splits = {}
+    for path in find_dbs(datadir):
+        splits.setdefault(os.path.dirname(path), []).append(path)
+
+    for split, paths in splits.items():
+        outpath = os.path.join(split, "tfrecords")
+        print(f"Writing {len(paths)} samples to: {outpath}")
+        stores = [open_lmdb(path) for path in paths]
+        write_tfrecords(stores, outpath, shard_size=config.shard_size, rng=bootstrap.rng())
+        for store in stores:
+            store.close()
+
+
+if __name__ == "__main__":
+    sys.exit(bootstrap.boot(main, sys.argv))
@@ -9,11 +9,11 @@ import sys
 import bootstrap
 
 # Import functions from the dnabert_finetune_autoencoder script.
-from dnabert_finetune_autoencoder import define_arguments, load_datasets, load_model, create_model
+from dnabert_finetune_autoencoder import define_arguments, align_dimensions, load_datasets, load_model, create_model, create_callbacks, worker_batches
 
 
 def train(config, model_path=None):
-    with bootstrap.strategy().scope():
+    with bootstrap.strategy(config).scope():
         # Create the autoencoder model
         if model_path is not None:
             model = load_model(model_path)
@@ -22,7 +22,7 @@ def train(config, model_path=None):
 
         # Disable training for the encoder
         model.encoder.trainable = False
-        model.compile(optimizer=model.optimizer, metrics=[
+        model.compile(optimizer=model.optimizer, jit_compile=config.jit_compile, metrics=[
             keras.metrics.SparseCategoricalAccuracy()
         ])
 
@@ -32,35 +32,41 @@ def train(config, model_path=None):
         train_data, val_data = load_datasets(config, length, kmer)
 
         # Create any collbacks we may need
-        callbacks = bootstrap.callbacks({})
+        callbacks = create_callbacks(config)
 
-        # Train the model with keyboard-interrupt protection
+        # Train the model with keyboard-interrupt protection. The step counts delimit the epochs
+        # of the infinite TFRecord pipelines so their iterators persist across epochs.
         bootstrap.run_safely(
             model.fit,
             train_data,
             validation_data=val_data,
-            initial_epoch=bootstrap.initial_epoch(),
+            steps_per_epoch=worker_batches(config.batches_per_epoch),
+            validation_steps=worker_batches(config.val_batches_per_epoch),
+            initial_epoch=bootstrap.initial_epoch(config),
+            subbatch_size=config.sub_batch_size,
             epochs=config.epochs,
             callbacks=callbacks,
-            use_multiprocessing=(config.data_workers > 1),
-            workers=config.data_workers)
+            verbose=(1 if bootstrap.is_primary_worker() else 0))
 
         # Save the model
-        bootstrap.save_model(model)
+        if config.save_to and bootstrap.is_primary_worker():
+            bootstrap.save_model(model, bootstrap.path_to(config.save_to))
 
     return model
 
 
 def main(argv):
-    # Job Information
-    job_info = {
-        "name": "dnabert-decoder",
-        "job_type": bootstrap.JobType.Train,
-        "group": "dnabert/decoder"
-    }
+    config = bootstrap.init(argv[1:], define_arguments)
 
-    # Initialize the job and load the config
-    job_config, config = bootstrap.init(argv, job_info, define_arguments)
+    # Set the random seed
+    bootstrap.random_seed(config.seed)
+
+    # Set the precision policy before any layers are constructed
+    bootstrap.mixed_precision(config)
+    align_dimensions(config)
+
+    # Start Horovod and pin this worker to its GPU
+    bootstrap.init_horovod(config)
 
     # If this is a resumed run, we need to fetch the latest model run
     model_path = None
@@ -69,14 +75,18 @@ def main(argv):
         model_path = bootstrap.restore_dir(config.save_to)
 
     # Train the model if necessary
-    if bootstrap.initial_epoch() < config.epochs:
+    if bootstrap.initial_epoch(config) < config.epochs:
         train(config, model_path)
 
     # Upload an artifact of the model if requested
-    if job_config.log_artifacts:
-        bootstrap.log_model_artifact(job_info["name"])
+    if config.log_artifact and bootstrap.is_primary_worker():
+        print("Logging artifact to", config.save_to)
+        assert bool(config.save_to)
+        bootstrap.log_artifact(config.log_artifact, [
+            bootstrap.path_to(config.save_to),
+            bootstrap.path_to(config.save_to) + ".h5"
+        ], type="model")
 
 
 if __name__ == "__main__":
-    sys.exit(main(sys.argv) or 0)
-
+    sys.exit(bootstrap.boot(main, sys.argv))
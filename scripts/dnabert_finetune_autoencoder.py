@@ -1,63 +1,145 @@
+import argparse
 import os
 import tensorflow as tf
 import tensorflow.keras as keras
 import sys
 
 import bootstrap
-from common.data import find_dbs, DnaLabelType, DnaSequenceGenerator
+from common.data import contiguous_path, find_dbs, open_lmdb, tfrecord_dataset, DnaLabelType, DnaSequenceGenerator
 from common.models import dnabert
-from common.utils import str_to_bool
+from common.utils import loss_scale_optimizer, str_to_bool
 
 
-def define_arguments(parser):
-    # Pretrained model
-    parser.add_argument("--pretrained-model-artifact", type=str, default=None)
+def define_arguments(cli):
+    # General config
+    cli.use_strategy()
+
+    # Dataset and pretrained model artifacts
+    cli.artifact("--dataset", type=str, required=True)
+    cli.artifact("--pretrained-model", type=str, required=True)
 
     # Architecture settings
-    parser.add_argument("--embed-dim", type=int, default=128)
-    parser.add_argument("--stack", type=int, default=4)
-    parser.add_argument("--num-heads", type=int, default=4)
-    parser.add_argument("--pre-layernorm", type=str_to_bool, default=True)
+    cli.argument("--embed-dim", type=int, default=128)
+    cli.argument("--stack", type=int, default=4)
+    cli.argument("--num-heads", type=int, default=4)
+    cli.argument("--pre-layernorm", type=str_to_bool, default=True)
 
     # Training settings
-    parser.add_argument("--batches-per-epoch", type=int, default=100)
-    parser.add_argument("--val-batches-per-epoch", type=int, default=16)
-    parser.add_argument("--data-augment", type=str_to_bool, default=True)
-    parser.add_argument("--data-balance", type=str_to_bool, default=False)
-    parser.add_argument("--data-workers", type=int, default=1)
-    parser.add_argument("--epochs", type=int, default=1)
-    parser.add_argument("--batch-size", type=int, default=2000)
-    parser.add_argument("--sub-batch-size", type=int, default=1000)
-    parser.add_argument("--optimizer", type=str, choices=["adam", "nadam"], default="adam")
-    parser.add_argument("--lr", type=float, default=4e-4)
-
-
-def load_dataset(config, datadir, length, kmer):
-    samples = find_dbs(datadir)
-    dataset = DnaSequenceGenerator(
+    cli.use_training(epochs=1, batch_size=2000, sub_batch_size=1000)
+    cli.argument("--micro-batch-size", dest="sub_batch_size", type=int, default=argparse.SUPPRESS, help="Alias of --sub-batch-size")
+    cli.argument("--seed", type=int, default=None)
+    cli.argument("--batches-per-epoch", type=int, default=100)
+    cli.argument("--val-batches-per-epoch", type=int, default=16)
+    cli.argument("--data-augment", type=str_to_bool, default=True)
+    cli.argument("--data-balance", type=str_to_bool, default=False)
+    cli.argument("--contiguous-data", action="store_true", default=False, help="Gather batches from contiguous sequence files instead of LMDB generators")
+    cli.argument("--data-in-memory", type=str_to_bool, default=False)
+    cli.argument("--data-memory-map", type=str_to_bool, default=False)
+    cli.argument("--optimizer", type=str, choices=["adam", "nadam"], default="adam")
+    cli.argument("--lr", type=float, default=4e-4)
+    cli.argument("--jit-compile", type=str_to_bool, default=True)
+    cli.argument("--horovod", action="store_true", default=False)
+    cli.argument("--warmup-epochs", type=int, default=5, help="Learning rate warmup epochs under Horovod")
+    cli.argument("--quantize-export", type=str_to_bool, default=False)
+    cli.argument("--quantize-calibration-batches", type=int, default=8)
+
+    # Logging
+    cli.argument("--save-to", type=str, default=None)
+    cli.argument("--log-artifact", type=str, default=None)
+
+
+def align_dimensions(config):
+    """
+    Round the batch sizes and embedding dimension up to multiples of 8 under mixed precision so
+    that the matrix multiplications are eligible for Tensor Cores. The batch size is rounded to a
+    multiple of the rounded sub-batch size so that it still divides evenly. Any adjusted values
+    are reported and recorded in the logged configuration.
+    """
+    if config.mixed_precision is None:
+        return
+    round_up = lambda x, m=8: -(-x // m) * m
+    aligned = {}
+    if config.sub_batch_size > 0:
+        aligned["sub_batch_size"] = round_up(config.sub_batch_size)
+        aligned["batch_size"] = round_up(config.batch_size, aligned["sub_batch_size"])
+    else:
+        aligned["batch_size"] = round_up(config.batch_size)
+    aligned["embed_dim"] = round_up(config.embed_dim)
+    if aligned["embed_dim"] % config.num_heads != 0:
+        raise ValueError(
+            f"The aligned embedding dimension ({aligned['embed_dim']}) must be divisible by the number of heads ({config.num_heads})")
+    changed = {k: v for k, v in aligned.items() if getattr(config, k) != v}
+    for key, value in changed.items():
+        print(f"Aligning {key} for mixed precision: {getattr(config, key)} -> {value}")
+        setattr(config, key, value)
+    if changed:
+        bootstrap.update_config(changed)
+
+
+def load_dataset(config, datadir, length, kmer, batches_per_epoch):
+    # Prefer the TFRecord shards written by convert_to_tfrecord.py if available
+    tfrecords_path = os.path.join(datadir, "tfrecords")
+    if os.path.isdir(tfrecords_path):
+        return tfrecord_dataset(
+            tfrecords_path,
+            sequence_length=length,
+            kmer=kmer,
+            batch_size=config.batch_size,
+            augment=config.data_augment,
+            labels=DnaLabelType.OneMer)
+    samples = [open_lmdb(path) for path in find_dbs(datadir)]
+    if config.data_in_memory or config.data_memory_map or config.contiguous_data:
+        # Export the contiguous sequence files once before any worker reads them
+        if bootstrap.is_primary_worker():
+            for store in samples:
+                contiguous_path(store)
+        bootstrap.barrier()
+    generator = DnaSequenceGenerator(
         samples=samples,
         sequence_length=length,
         kmer=kmer,
         batch_size=config.batch_size,
-        batches_per_epoch=config.batches_per_epoch,
+        batches_per_epoch=batches_per_epoch,
         augment=config.data_augment,
         balance=config.data_balance,
         labels=DnaLabelType.OneMer,
+        in_memory=config.data_in_memory,
+        memory_map=config.data_memory_map,
         rng=bootstrap.rng())
-    return dataset
+    return generator.to_tf_dataset(contiguous=config.contiguous_data)
+
+
+def worker_batches(batches_per_epoch):
+    """
+    The number of batches each Horovod worker draws per epoch.
+    """
+    hvd = bootstrap.horovod()
+    return max(1, batches_per_epoch // (hvd.size() if hvd is not None else 1))
 
 
 def load_datasets(config, length, kmer):
-    datadir = bootstrap.use_dataset(config)
+    datadir = bootstrap.artifact(config, "dataset")
     datasets = []
-    for folder in ("train", "validation"):
-        datasets.append(load_dataset(config, os.path.join(datadir, folder), length, kmer))
+    for folder, batches_per_epoch in (
+        ("train", config.batches_per_epoch),
+        ("validation", config.val_batches_per_epoch)
+    ):
+        batches_per_epoch = worker_batches(batches_per_epoch)
+        # Input pipelines only perform host-side work, so keep their ops on the CPU
+        with tf.device("/CPU:0"):
+            datasets.append(load_dataset(config, os.path.join(datadir, folder), length, kmer, batches_per_epoch))
     return datasets
 
 
 def create_model(config):
+    # Equal sub-batches keep the training step to a single traced/compiled shape
+    if config.sub_batch_size > 0 and config.batch_size % config.sub_batch_size != 0:
+        raise ValueError(
+            f"The batch size ({config.batch_size}) must be divisible by the sub-batch size ({config.sub_batch_size})")
+    hvd = bootstrap.horovod()
+
     # Fetch the pretrained DNABERT model
-    pretrain_path = bootstrap.use_model(config.pretrained_model_artifact)
+    pretrain_path = bootstrap.artifact(config, "pretrained_model")
 
     # Create the model
     base = dnabert.DnaBertPretrainModel.load(pretrain_path).base
@@ -71,17 +153,23 @@ def create_model(config):
         pre_layernorm=config.pre_layernorm)
     model = dnabert.DnaBertAutoencoderModel(encoder, decoder)
 
-    # Select an optimizer
+    # Select an optimizer, scaling the learning rate with the number of Horovod workers
+    lr = config.lr * (hvd.size() if hvd is not None else 1)
     if config.optimizer == "adam":
-        optimizer = keras.optimizers.Adam(config.lr)
+        optimizer = keras.optimizers.Adam(lr)
     elif config.optimizer == "nadam":
-        optimizer = keras.optimizers.Nadam(config.lr)
+        optimizer = keras.optimizers.Nadam(lr)
+    if hvd is not None:
+        optimizer = hvd.DistributedOptimizer(optimizer)
+    optimizer = loss_scale_optimizer(optimizer)
 
     # Compile and return the model
-    model.compile(optimizer=optimizer, metrics=[
+    model.compile(optimizer=optimizer, jit_compile=config.jit_compile, metrics=[
         keras.metrics.SparseCategoricalAccuracy()
     ])
-    model(tf.zeros((1, encoder.base.length - encoder.base.kmer + 1)))
+    # Warm up on the CPU so no worker implicitly touches another worker's GPU
+    with tf.device("/CPU:0"):
+        model(tf.zeros((1, encoder.base.length - encoder.base.kmer + 1)))
     model.summary()
     return model
 
@@ -91,8 +179,86 @@ def load_model(path):
     return dnabert.DnaBertAutoencoderModel.load(path)
 
 
+def float32_copy(model):
+    """
+    Rebuild the autoencoder under a float32 policy with the trained weights, since the TFLite
+    converter cannot quantize the half-precision operations of a mixed-precision model.
+    """
+    policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy("float32")
+    try:
+        base, decoder = model.encoder.base, model.decoder
+        copy = dnabert.DnaBertAutoencoderModel(
+            dnabert.DnaBertEncoderModel(
+                dnabert.DnaBertModel(
+                    length=base.length,
+                    kmer=base.kmer,
+                    embed_dim=base.embed_dim,
+                    stack=base.stack,
+                    num_heads=base.num_heads,
+                    pre_layernorm=base.pre_layernorm),
+                use_kmer_encoder=model.encoder.use_kmer_encoder),
+            dnabert.DnaBertDecoderModel(
+                length=decoder.length,
+                embed_dim=decoder.embed_dim,
+                stack=decoder.stack,
+                num_heads=decoder.num_heads,
+                latent_dim=decoder.latent_dim,
+                pre_layernorm=decoder.pre_layernorm))
+    finally:
+        keras.mixed_precision.set_global_policy(policy)
+    with tf.device("/CPU:0"):
+        copy(tf.zeros((1, base.length - base.kmer + 1), dtype=tf.int32))
+    copy.set_weights(model.get_weights())
+    return copy
+
+
+def export_quantized(model, dataset, num_batches, path):
+    """
+    Export the model as a TFLite model with int8 post-training quantized weights and
+    activations, calibrated on a few batches of the given dataset.
+    """
+    if keras.mixed_precision.global_policy().compute_dtype != "float32":
+        model = float32_copy(model)
+    length = model.encoder.base.length - model.encoder.base.kmer + 1
+    # Trace with the integer k-mer input the data pipeline actually produces
+    predict = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+        tf.TensorSpec((1, length), tf.int32))
+    def representative_dataset():
+        for x, _ in dataset.take(num_batches):
+            for sequence in x:
+                yield [tf.cast(sequence[tf.newaxis], tf.int32)]
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([predict], model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    tflite_model = converter.convert()
+    with open(path, "wb") as f:
+        f.write(tflite_model)
+    print(f"Quantized model exported to: {path}")
+
+
+def create_callbacks(config):
+    hvd = bootstrap.horovod()
+    callbacks = []
+    if hvd is not None:
+        callbacks += [
+            hvd.callbacks.BroadcastGlobalVariablesCallback(0),
+            hvd.callbacks.MetricAverageCallback()
+        ]
+        # Ramp the scaled learning rate up from the single-worker rate
+        if config.warmup_epochs > 0:
+            callbacks.append(hvd.callbacks.LearningRateWarmupCallback(
+                initial_lr=config.lr * hvd.size(),
+                warmup_epochs=config.warmup_epochs,
+                steps_per_epoch=worker_batches(config.batches_per_epoch),
+                verbose=(1 if bootstrap.is_primary_worker() else 0)))
+    if bootstrap.is_using_wandb() and bootstrap.is_primary_worker():
+        callbacks.append(bootstrap.wandb_callback(save_weights_only=True))
+    return callbacks
+
+
 def train(config, model_path=None):
-    with bootstrap.strategy().scope():
+    with bootstrap.strategy(config).scope():
         # Create the autoencoder model
         if model_path is not None:
             model = load_model(model_path)
@@ -105,37 +271,47 @@ def train(config, model_path=None):
         train_data, val_data = load_datasets(config, length, kmer)
 
         # Create any collbacks we may need
-        callbacks = bootstrap.callbacks({})
+        callbacks = create_callbacks(config)
 
-        # Train the model with keyboard-interrupt protection
+        # Train the model with keyboard-interrupt protection. The step counts delimit the epochs
+        # of the infinite TFRecord pipelines so their iterators persist across epochs.
         bootstrap.run_safely(
             model.fit,
             train_data,
             validation_data=val_data,
-            initial_epoch=bootstrap.initial_epoch(),
+            steps_per_epoch=worker_batches(config.batches_per_epoch),
+            validation_steps=worker_batches(config.val_batches_per_epoch),
+            initial_epoch=bootstrap.initial_epoch(config),
             subbatch_size=config.sub_batch_size,
             epochs=config.epochs,
             callbacks=callbacks,
-            use_multiprocessing=(config.data_workers > 1),
-            workers=config.data_workers)
+            verbose=(1 if bootstrap.is_primary_worker() else 0))
 
         # Save the model
-        bootstrap.save_model(model)
+        if config.save_to and bootstrap.is_primary_worker():
+            bootstrap.save_model(model, bootstrap.path_to(config.save_to))
+            if config.quantize_export:
+                export_quantized(
+                    model,
+                    val_data,
+                    config.quantize_calibration_batches,
+                    bootstrap.path_to(config.save_to + "-int8.tflite"))
 
     return model
 
 
 def main(argv):
-    # Job Information
-    job_info = {
-        "name": "finetune",
-        "job_type": bootstrap.JobType.Finetune,
-        "project": os.environ["WANDB_PROJECT_DNABERT_AUTOENCODER"],
-        "group": "finetune"
-    }
+    config = bootstrap.init(argv[1:], define_arguments)
+
+    # Set the random seed
+    bootstrap.random_seed(config.seed)
+
+    # Set the precision policy before any layers are constructed
+    bootstrap.mixed_precision(config)
+    align_dimensions(config)
 
-    # Initialize the job and load the config
-    job_config, config = bootstrap.init(argv, job_info, define_arguments)
+    # Start Horovod and pin this worker to its GPU
+    bootstrap.init_horovod(config)
 
     # If this is a resumed run, we need to fetch the latest model run
     model_path = None
@@ -144,15 +320,20 @@ def main(argv):
         model_path = bootstrap.restore_dir(config.save_to)
 
     # Train the model if necessary
-    if bootstrap.initial_epoch() < config.epochs:
+    if bootstrap.initial_epoch(config) < config.epochs:
         train(config, model_path)
     else:
         print("Skipping training...")
 
     # Upload an artifact of the model if requested
-    if job_config.log_artifacts:
-        bootstrap.log_model_artifact(bootstrap.group().replace('/', '-'))
+    if config.log_artifact and bootstrap.is_primary_worker():
+        print("Logging artifact to", config.save_to)
+        assert bool(config.save_to)
+        bootstrap.log_artifact(config.log_artifact, [
+            bootstrap.path_to(config.save_to),
+            bootstrap.path_to(config.save_to) + ".h5"
+        ], type="model")
 
 
 if __name__ == "__main__":
-    sys.exit(bootstrap.boot(main, (sys.argv,)) or 0)
+    sys.exit(bootstrap.boot(main, sys.argv))
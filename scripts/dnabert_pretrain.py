@@ -32,6 +32,7 @@ def define_arguments(cli):
     cli.argument("--val-batches-per-epoch", type=int, default=16)
     cli.argument("--data-augment", type=str_to_bool, default=True)
     cli.argument("--data-balance", type=str_to_bool, default=False)
+    cli.argument("--contiguous-data", action="store_true", default=False, help="Gather batches from contiguous sequence files instead of LMDB generators")
     cli.argument("--mask-ratio", type=float, default=0.15)
     cli.argument("--optimizer", type=str, choices=["adam", "nadam"], default="adam")
     cli.argument("--lr", type=float, default=4e-4)
@@ -60,7 +61,9 @@ def load_datasets(config):
         labels=DnaLabelType.KMer,
         rng=bootstrap.rng()
     )
-    return (train, val)
+    return (
+        train.to_tf_dataset(contiguous=config.contiguous_data),
+        val.to_tf_dataset(contiguous=config.contiguous_data))
 
 
 def create_model(config):
@@ -137,9 +140,7 @@ def train(config, model_path, weights_path):
             subbatch_size=config.sub_batch_size,
             initial_epoch=bootstrap.initial_epoch(config),
             epochs=config.epochs,
-            callbacks=callbacks,
-            use_multiprocessing=(config.data_workers > 1),
-            workers=config.data_workers)
+            callbacks=callbacks)
 
         # Save the model
         if config.save_to:
@@ -154,6 +155,9 @@ def main(argv):
     # Set the random seed
     bootstrap.random_seed(config.seed)
 
+    # Set the precision policy before any layers are constructed
+    bootstrap.mixed_precision(config)
+
     # If this is a resumed run, we need to fetch the latest model run
     model_path = None
     weights_path = None
@@ -4,7 +4,7 @@ import tensorflow.keras as keras
 import sys
 
 import bootstrap
-from common.data import find_dbs, random_subsamples, DnaLabelType, DnaSampleGenerator
+from common.data import find_dbs, open_lmdb, random_subsamples, DnaLabelType, DnaSampleGenerator
 from common.models import dnabert, dnagast, gast
 from common.utils import plt_to_image, str_to_bool
 
@@ -47,6 +47,8 @@ def define_arguments(parser):
     parser.add_argument("--optimizer", type=str, choices=["adam", "nadam"], default="adam")
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--encoder-batch-size", type=int, default=512)
+    parser.add_argument("--mixed-precision", type=str, choices=["mixed_float16", "mixed_bfloat16"], default=None)
+    parser.add_argument("--jit-compile", type=str_to_bool, default=False)
     parser.add_argument("--subsample-length", type=int, default=1000)
     parser.add_argument("--num_control_subsamples", type=int, default=10)
     parser.add_argument("--num_test_subsamples", type=int, default=5)
@@ -59,9 +61,9 @@ def fetch_dna_samples(config):
     return samples
 
 
-def load_dataset(config, samples, encoder):
-    dataset = DnaSampleGenerator(
-        samples=samples,
+def load_dataset(config, stores, encoder):
+    generator = DnaSampleGenerator(
+        samples=stores,
         sequence_length=encoder.base.length,
         subsample_length=config.subsample_length,
         kmer=1,
@@ -70,8 +72,9 @@ def load_dataset(config, samples, encoder):
         augment=config.data_augment,
         balance=config.data_balance,
         labels=DnaLabelType.SampleIds,
-        rng=bootstrap.rng())
-    return dataset
+        rng=bootstrap.rng(),
+        _delay_init=False)
+    return generator.to_tf_dataset()
 
 
 def create_model(config, num_samples):
@@ -128,7 +131,8 @@ def create_model(config, num_samples):
         generator_optimizer=Optimizer(config.lr),
         discriminator_optimizer=Optimizer(config.lr),
         generator_metrics=[keras.metrics.SparseCategoricalAccuracy(name="generator_accuracy")],
-        discriminator_metrics=[keras.metrics.SparseCategoricalAccuracy(name="discriminator_accuracy")])
+        discriminator_metrics=[keras.metrics.SparseCategoricalAccuracy(name="discriminator_accuracy")],
+        jit_compile=config.jit_compile)
 
     generator.summary()
     discriminator.summary()
@@ -141,8 +145,9 @@ def load_model(path):
 
 
 class DnaGastMdsCallback(keras.callbacks.Callback):
-    def __init__(self, samples, subsample_size, control_subsamples_per_sample, test_subsamples_per_sample, augment=True, balance=False, p=1, workers=1, rng=np.random.default_rng()):
+    def __init__(self, samples, stores, subsample_size, control_subsamples_per_sample, test_subsamples_per_sample, augment=True, balance=False, p=1, workers=1, rng=np.random.default_rng()):
         self.samples = samples
+        self.stores = stores
         self.subsample_size = subsample_size
         self.control_subsamples_per_sample = control_subsamples_per_sample
         self.test_subsamples_per_sample = test_subsamples_per_sample
@@ -160,7 +165,7 @@ class DnaGastMdsCallback(keras.callbacks.Callback):
 
     def generate_random_subsamples(self, batch_size):
         subsamples = random_subsamples(
-            samples=self.samples,
+            samples=self.stores,
             sequence_length=self.encoder.base.length,
             subsample_size=self.subsample_size,
             subsamples_per_sample=self.control_subsamples_per_sample,
@@ -242,10 +247,11 @@ class DnaGastMdsCallback(keras.callbacks.Callback):
         })
 
 
-def create_callbacks(config, test_samples):
+def create_callbacks(config, test_samples, test_stores):
     callbacks = bootstrap.callbacks()
     callbacks.append(DnaGastMdsCallback(
         samples=test_samples,
+        stores=test_stores,
         subsample_size=config.subsample_length,
         control_subsamples_per_sample=config.num_control_subsamples,
         test_subsamples_per_sample=config.num_test_subsamples,
@@ -268,11 +274,13 @@ def train(config, model_path=None):
         else:
             model = create_model(config, num_samples=len(samples))
 
-        # Load the dataset
-        data = load_dataset(config, samples, model.encoder)
+        # Load the dataset. The stores are shared with the MDS callback since an LMDB
+        # environment can only be opened once per process.
+        stores = [open_lmdb(path) for path in samples]
+        data = load_dataset(config, stores, model.encoder)
 
         # Create any collbacks we may need
-        callbacks = create_callbacks(config, samples)
+        callbacks = create_callbacks(config, samples, stores)
 
         # Train the model with keyboard-interrupt protection
         bootstrap.run_safely(
@@ -280,9 +288,7 @@ def train(config, model_path=None):
             data,
             initial_epoch=bootstrap.initial_epoch(),
             epochs=config.epochs,
-            callbacks=callbacks,
-            use_multiprocessing=(config.data_workers > 1),
-            workers=config.data_workers)
+            callbacks=callbacks)
 
         # # Save the model
         bootstrap.save_model(model)
@@ -301,6 +307,9 @@ def main(argv):
     # Initialize the job and load the config
     job_config, config = bootstrap.init(argv, job_info, define_arguments)
 
+    # Set the precision policy before any layers are constructed
+    bootstrap.mixed_precision(config)
+
     # If this is a resumed run, we need to fetch the latest model run
     model_path = None
     if bootstrap.is_resumed():
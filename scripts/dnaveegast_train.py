@@ -6,7 +6,7 @@ import tensorflow.keras as keras
 import sys
 
 import bootstrap
-from common.data import find_dbs, random_subsamples, DnaLabelType, DnaSampleGenerator
+from common.data import find_dbs, open_lmdb, random_subsamples, DnaLabelType, DnaSampleGenerator
 from common.models import dnabert, dnagast, gast
 from common.utils import plt_to_image, str_to_bool
 
@@ -54,6 +54,7 @@ def define_arguments(cli):
     cli.argument("--optimizer", type=str, choices=["adam", "nadam"], default="adam")
     cli.argument("--lr", type=float, default=1e-4)
     cli.argument("--encoder-batch-size", type=int, default=512)
+    cli.argument("--jit-compile", type=str_to_bool, default=False)
     cli.argument("--subsample-length", type=int, default=1000)
     cli.argument("--num_control_subsamples", type=int, default=10)
     cli.argument("--num_test_subsamples", type=int, default=5)
@@ -70,9 +71,9 @@ def fetch_dna_samples(config):
     return samples
 
 
-def load_dataset(config, samples, encoder):
-    dataset = DnaSampleGenerator(
-        samples=samples,
+def load_dataset(config, stores, encoder):
+    generator = DnaSampleGenerator(
+        samples=stores,
         sequence_length=encoder.base.length,
         subsample_length=config.subsample_length,
         kmer=1,
@@ -81,8 +82,9 @@ def load_dataset(config, samples, encoder):
         augment=config.data_augment,
         balance=config.data_balance,
         labels=DnaLabelType.SampleIds,
-        rng=bootstrap.rng())
-    return dataset
+        rng=bootstrap.rng(),
+        _delay_init=False)
+    return generator.to_tf_dataset()
 
 
 def create_model(config, num_samples):
@@ -155,7 +157,8 @@ def create_model(config, num_samples):
         reconstructor_optimizer=Optimizer(config.lr),
         discriminator_optimizer=Optimizer(config.lr),
         generator_metrics=[keras.metrics.SparseCategoricalAccuracy(name="generator_accuracy")],
-        discriminator_metrics=[keras.metrics.SparseCategoricalAccuracy(name="discriminator_accuracy")])
+        discriminator_metrics=[keras.metrics.SparseCategoricalAccuracy(name="discriminator_accuracy")],
+        jit_compile=config.jit_compile)
 
     generator.summary()
     discriminator.summary()
@@ -169,8 +172,9 @@ def load_model(path):
 
 
 class DnaGastMdsCallback(keras.callbacks.Callback):
-    def __init__(self, samples, subsample_size, control_subsamples_per_sample, test_subsamples_per_sample, batch_size, encoder_batch_size, augment=True, balance=False, p=1, workers=1, rng=np.random.default_rng()):
+    def __init__(self, samples, stores, subsample_size, control_subsamples_per_sample, test_subsamples_per_sample, batch_size, encoder_batch_size, augment=True, balance=False, p=1, workers=1, rng=np.random.default_rng()):
         self.samples = samples
+        self.stores = stores
         self.subsample_size = subsample_size
         self.control_subsamples_per_sample = control_subsamples_per_sample
         self.test_subsamples_per_sample = test_subsamples_per_sample
@@ -190,7 +194,7 @@ class DnaGastMdsCallback(keras.callbacks.Callback):
 
     def generate_random_subsamples(self, batch_size):
         subsamples = random_subsamples(
-            sample_paths=self.samples,
+            samples=self.stores,
             sequence_length=self.encoder.base.length,
             subsample_size=self.subsample_size,
             subsamples_per_sample=self.control_subsamples_per_sample,
@@ -271,12 +275,13 @@ class DnaGastMdsCallback(keras.callbacks.Callback):
         })
 
 
-def create_callbacks(config, test_samples):
+def create_callbacks(config, test_samples, test_stores):
     callbacks = []
     if bootstrap.is_using_wandb():
         callbacks.append(bootstrap.wandb_callback(save_weights_only=True))
     callbacks.append(DnaGastMdsCallback(
         samples=test_samples,
+        stores=test_stores,
         subsample_size=config.subsample_length,
         control_subsamples_per_sample=config.num_control_subsamples,
         test_subsamples_per_sample=config.num_test_subsamples,
@@ -301,11 +306,13 @@ def train(config, model_path=None, weights_path=None):
         else:
             model = create_model(config, num_samples=len(samples))
 
-        # Load the dataset
-        data = load_dataset(config, samples, model.encoder)
+        # Load the dataset. The stores are shared with the MDS callback since an LMDB
+        # environment can only be opened once per process.
+        stores = [open_lmdb(path) for path in samples]
+        data = load_dataset(config, stores, model.encoder)
 
         # Create any collbacks we may need
-        callbacks = create_callbacks(config, samples)
+        callbacks = create_callbacks(config, samples, stores)
 
         # Train the model with keyboard-interrupt protection
         bootstrap.run_safely(
@@ -314,9 +321,7 @@ def train(config, model_path=None, weights_path=None):
             initial_epoch=bootstrap.initial_epoch(config),
             subbatch_size=config.sub_batch_size,
             epochs=config.epochs,
-            callbacks=callbacks,
-            use_multiprocessing=(config.data_workers > 1),
-            workers=config.data_workers)
+            callbacks=callbacks)
 
         # # Save the model
         bootstrap.save_model(model, bootstrap.path_to(config.save_to))
@@ -325,7 +330,10 @@ def train(config, model_path=None, weights_path=None):
 
 def main(argv):
     config = bootstrap.init(argv[1:], define_arguments)
-    
+
+    # Set the precision policy before any layers are constructed
+    bootstrap.mixed_precision(config)
+
     # If this is a resumed run, we need to fetch the latest model run
     model_path = None
     weights_path = None